@@ -1,109 +1,230 @@
 import os
+import io
 import csv
+import json
+import re
+import time
+import shelve
+import asyncio
+import hashlib
+import tiktoken
 from collections import defaultdict
 from dotenv import load_dotenv
-from openai import OpenAI
+from openai import AsyncOpenAI, APIConnectionError, APITimeoutError, InternalServerError, RateLimitError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_random_exponential
 from tqdm import tqdm
 
 # 🔹 Load API key
 load_dotenv()
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+# Retries are left to tenacity so every attempt goes through the rate limiter
+client = AsyncOpenAI(api_key=os.getenv("OPENAI_API_KEY"), max_retries=0)
 
 # 🔹 Paths
 txt_folder = "./txt_outputs"
 output_folder = "./csv_outputs"
 os.makedirs(output_folder, exist_ok=True)
+write_buffer_size = 1 << 20
+
+# 🔹 Model and context budget
+model_name = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
+# Models with json_schema structured outputs: (context window, max output tokens).
+# Snapshots are listed explicitly: older ones (e.g. gpt-4o-2024-05-13) lack json_schema.
+model_limits = {
+    "gpt-4o-mini": (128000, 16384),
+    "gpt-4o-mini-2024-07-18": (128000, 16384),
+    "gpt-4o": (128000, 16384),
+    "gpt-4o-2024-08-06": (128000, 16384),
+    "gpt-4o-2024-11-20": (128000, 16384),
+    "gpt-4.1": (1047576, 32768),
+    "gpt-4.1-2025-04-14": (1047576, 32768),
+    "gpt-4.1-mini": (1047576, 32768),
+    "gpt-4.1-mini-2025-04-14": (1047576, 32768),
+    "gpt-4.1-nano": (1047576, 32768),
+    "gpt-4.1-nano-2025-04-14": (1047576, 32768),
+}
+if model_name not in model_limits:
+    raise ValueError(
+        f"OPENAI_MODEL={model_name} is not supported; use one of: {', '.join(model_limits)}"
+    )
+context_window, max_output_tokens = model_limits[model_name]
+max_completion_tokens = min(8000, max_output_tokens)  # page packing puts more questions in each reply
+row_overhead_tokens = 20  # JSON around one question: {"question": "", "marks": 5, "page": 12, "year": 1990},
+try:
+    encoding = tiktoken.encoding_for_model(model_name)
+except KeyError:
+    encoding = tiktoken.get_encoding("o200k_base")
+
+# 🔹 Response cache (bump prompt_version whenever the prompt changes)
+cache_path = "./.llm_cache"
+prompt_version = 5
+
+# 🔹 Structured output: the model returns JSON, CSV is written locally
+csv_header = ["question", "marks", "paper_title", "filename", "page", "year"]
+exam_schema = {
+    "name": "exam",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "paper_title": {"type": "string"},
+            "questions": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "question": {"type": "string"},
+                        "marks": {"type": "integer"},
+                        "page": {"type": "integer"},
+                        "year": {"type": "integer"},
+                    },
+                    "required": ["question", "marks", "page", "year"],
+                    "additionalProperties": False,
+                },
+            },
+        },
+        "required": ["paper_title", "questions"],
+        "additionalProperties": False,
+    },
+}
+
+# 🔹 Rate limits (overridden by the account limits probed at startup)
+max_requests_per_minute = 500
+max_tokens_per_minute = 60000
+
+# 🔹 Batch API (50% cheaper, results within the completion window)
+use_batch_api = True
+batch_poll_interval = 30  # seconds
+
+
+page_file_pattern = re.compile(r"^(?P<prefix>.+?)(?:_page_(?P<page>\d+))?\.txt$")
 
 
 def group_files():
-    """Group text files by exam prefix (before _page_X)."""
+    """Group text files by exam prefix (before _page_X) as page-sorted (page_number, filename) lists."""
     groups = defaultdict(list)
 
     if not os.path.exists(txt_folder):
         print(f" Folder {txt_folder} does not exist!")
         return groups
 
-    for filename in os.listdir(txt_folder):
-        if filename.endswith(".txt"):
-            if "_page_" in filename:
-                exam_prefix = filename.split("_page_")[0]
-                groups[exam_prefix].append(filename)
-            else:
-                base_name = filename.replace(".txt", "")
-                groups[base_name].append(filename)
+    with os.scandir(txt_folder) as entries:
+        for entry in entries:
+            match = page_file_pattern.match(entry.name)
+            if match:
+                page_number = int(match["page"]) if match["page"] else 1
+                groups[match["prefix"]].append((page_number, entry.name))
+
+    for files in groups.values():
+        files.sort()
 
     return groups
 
 
-def extract_page_number(filename):
-    """Extract page number from filename like _page_2.txt."""
-    if "_page_" in filename:
+def read_exam_pages(page_files):
+    """Read (page_number, filename) pairs from group_files into (page_number, text) pairs."""
+    pages = []
+    for page_number, filename in page_files:
+        txt_path = os.path.join(txt_folder, filename)
         try:
-            return int(filename.split("_page_")[1].split(".")[0])
-        except (IndexError, ValueError):
-            return 1
-    return 1
+            with open(txt_path, "r", encoding="utf-8") as f:
+                text = f.read()
+        except Exception as e:
+            print(f" Error reading {filename}: {e}")
+            continue
+
+        pages.append((page_number, text))
+    return pages
+
+
+def count_tokens(text):
+    """Exact prompt token count for the configured model."""
+    return len(encoding.encode(text))
+
 
+def estimate_reply_tokens(text, block_tokens):
+    """Upper estimate of the reply for one page: every non-empty line could be a question
+    that is copied back with its JSON row around it."""
+    rows = sum(1 for line in text.splitlines() if line.strip())
+    return block_tokens + rows * row_overhead_tokens
 
-def chunk_text_by_pages(sorted_files, max_pages_per_chunk=8):
-    """Split exam into chunks of N pages each."""
+
+def chunk_pages_by_tokens(pages, token_budget, reply_budget, max_pages_per_chunk=16):
+    """Pack page blocks into chunks whose prompt fits token_budget and whose
+    estimated reply fits reply_budget."""
     chunks = []
     current_chunk = []
-    for i, filename in enumerate(sorted_files, 1):
-        current_chunk.append(filename)
-        if len(current_chunk) >= max_pages_per_chunk or i == len(sorted_files):
+    current_tokens = 0
+    current_reply_tokens = 0
+    for page_number, text in pages:
+        block = f"--- Page {page_number} ---\n{text}\n\n"
+        block_tokens = count_tokens(block)
+        reply_tokens = estimate_reply_tokens(text, block_tokens)
+        if current_chunk and (
+            current_tokens + block_tokens > token_budget
+            or current_reply_tokens + reply_tokens > reply_budget
+            or len(current_chunk) >= max_pages_per_chunk
+        ):
             chunks.append(current_chunk)
             current_chunk = []
+            current_tokens = 0
+            current_reply_tokens = 0
+        current_chunk.append(block)
+        current_tokens += block_tokens
+        current_reply_tokens += reply_tokens
+    if current_chunk:
+        chunks.append(current_chunk)
     return chunks
 
 
-def process_exam(exam_prefix, sorted_files):
-    """Process exam in chunks so large exams don’t exceed context window."""
-    all_csv_rows = []
-
-    # 🔹 Split exam pages into manageable chunks
-    file_chunks = chunk_text_by_pages(sorted_files, max_pages_per_chunk=8)
+def build_exam_chunks(pages):
+    """Split exam pages into (chunk_idx, page_blocks) chunks so large exams don’t exceed context window."""
+    pages = [(page_number, text) for page_number, text in pages if text.strip()]
+    if not pages:
+        return []
 
-    for chunk_idx, file_chunk in enumerate(file_chunks, 1):
-        combined_text = ""
-        for filename in file_chunk:
-            page_number = extract_page_number(filename)
-            txt_path = os.path.join(txt_folder, filename)
-            try:
-                with open(txt_path, "r", encoding="utf-8") as f:
-                    text = f.read()
-            except Exception as e:
-                print(f" Error reading {filename}: {e}")
-                continue
+    # 🔹 Fill each call up to the context window (minus prompt boilerplate and reply),
+    # but stop early when the questions on the packed pages wouldn't fit in one reply
+    prompt_overhead = count_tokens(system_prompt) + count_tokens(build_prompt(""))
+    token_budget = context_window - max_completion_tokens - prompt_overhead
+    reply_budget = max_completion_tokens - 200  # room for paper_title and the JSON wrapper
+    page_chunks = chunk_pages_by_tokens(pages, token_budget, reply_budget)
 
-            if not text.strip():
-                continue
+    return list(enumerate(page_chunks, 1))
 
-            combined_text += f"--- Page {page_number} ---\n{text}\n\n"
-
-        if not combined_text.strip():
-            continue
 
-        # 🔹 Your detailed prompt with sample input/output
-        prompt = f"""You are a CSV data extractor for medical exam papers. 
-Convert the following MULTI-PAGE exam text into CSV format.
-
-### OUTPUT FORMAT ###
-Each row must follow this exact structure:
-question,marks,paper_title,filename,page,year
+# 🔹 Static instructions with sample input/output. Kept byte-identical and first in
+# every request so OpenAI's automatic prompt caching (1024+ token prefixes) applies.
+system_prompt = """You are a precise data extractor for medical exam papers.
+Extract every question from the MULTI-PAGE exam text in the user message and output only JSON matching the schema.
 
 ### RULES ###
-1. Use the exam heading (from the first page) as paper_title for ALL rows.
+1. Use the exam heading (from the first page) as paper_title.
 2. Extract EVERY question from ALL pages (including subparts a, b, c).
 3. Clean questions: remove numbering, keep only the actual question text.
 4. Set marks = 5 for each question unless stated otherwise.
-5. Use filename: {exam_prefix}.pdf
-6. Use the correct page number (from the markers like --- Page 2 ---).
-7. Extract year from the exam date in the heading (e.g., "March 1990" → 1990).
-8. Put quotes around fields that contain commas.
-9. Output ONLY CSV rows (no headers, no notes).
-
-### SAMPLE INPUT ###
+5. Fill page with the number from the marker above the question (e.g., --- Page 2 --- → 2).
+6. Extract year from the exam date in the heading (e.g., "March 1990" → 1990).
+7. Skip everything that is not a question: register numbers, time allowed, maximum marks,
+   instructions such as "Answer ALL questions", section titles and page headers/footers.
+8. When a question introduces subparts ("Write notes on:", "Discuss:"), repeat that lead-in
+   in front of each subpart, as in the samples.
+9. When marks are printed next to a question or a group of questions (e.g., "(10 marks)",
+   "2 x 15 = 30"), use the marks for a single question.
+10. When a question offers an alternative ("OR"), extract both alternatives as separate questions
+    with the same marks.
+11. For multiple-choice questions, keep the stem and all options together in one question;
+    never output the options as separate questions.
+12. Repair OCR artefacts only where the meaning is obvious (words broken across lines, stray
+    symbols such as "|" or "~"); never reword, summarise or translate a question.
+13. Two-digit years belong to the 1900s or 2000s as the heading makes clear (e.g., "Feb. '97" → 1997).
+14. If the text contains no questions at all, return an empty questions list.
+15. The page number is always taken from the --- Page N --- marker, never from page numbers
+    printed inside the text itself (e.g., "Page 2 of 4" or "- 3 -" in a footer).
+16. The text may start partway through an exam, without its heading. In that case use the
+    heading-like lines you can find (university, degree, subject) as paper_title, and use
+    the year from any date that appears; keep paper_title identical for every question.
+
+### SAMPLE INPUT 1 ###
 --- Page 1 ---
 M.S. DEGREE EXAMINATION, March 1990
 General Surgery – Applied Basic Sciences
@@ -115,53 +236,405 @@ PHYSIOLOGY
 (a) Pain pathway
 (b) Cardiac cycle
 
-### SAMPLE OUTPUT ###
-"Describe the surgical anatomy of the thyroid gland",5,"M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences","{exam_prefix}.pdf",1,1990
-"Write notes on: Deep palmar spaces",5,"M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences","{exam_prefix}.pdf",1,1990
-"Write notes on: Femoral canal",5,"M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences","{exam_prefix}.pdf",1,1990
-"Pain pathway",5,"M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences","{exam_prefix}.pdf",2,1990
-"Cardiac cycle",5,"M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences","{exam_prefix}.pdf",2,1990
+### SAMPLE OUTPUT 1 ###
+{"paper_title": "M.S. DEGREE EXAMINATION, March 1990 – General Surgery – Applied Basic Sciences", "questions": [
+{"question": "Describe the surgical anatomy of the thyroid gland", "marks": 5, "page": 1, "year": 1990},
+{"question": "Write notes on: Deep palmar spaces", "marks": 5, "page": 1, "year": 1990},
+{"question": "Write notes on: Femoral canal", "marks": 5, "page": 1, "year": 1990},
+{"question": "Pain pathway", "marks": 5, "page": 2, "year": 1990},
+{"question": "Cardiac cycle", "marks": 5, "page": 2, "year": 1990}]}
 
-### TEXT TO CONVERT (chunk {chunk_idx}) ###
-{combined_text}
+### SAMPLE INPUT 2 ###
+--- Page 1 ---
+[KC 229] Sub. Code: 2041
+M.D. DEGREE EXAMINATION, SEPTEMBER 2008
+Branch I – General Medicine
+Paper II – Cardiology and Respiratory Medicine
+Time: Three hours  Maximum: 100 marks
+Answer ALL questions.
+I. Essay questions: (2 x 20 = 40)
+1. Discuss the aetiology, clinical features and management of infective endocarditis.
+2. Describe the approach to a patient with haemoptysis.
+
+--- Page 2 ---
+II. Write short notes on: (6 x 10 = 60)
+(a) Holter monitoring.
+(b) Pulmonary function tests.
+(c) Digoxin toxicity.
+(d) Sleep apnoea syndrome.
+(e) Brugada syndrome.
+(f) Bronchial thermoplasty.
+*******
+
+### SAMPLE OUTPUT 2 ###
+{"paper_title": "M.D. DEGREE EXAMINATION, SEPTEMBER 2008 – General Medicine – Paper II – Cardiology and Respiratory Medicine", "questions": [
+{"question": "Discuss the aetiology, clinical features and management of infective endocarditis", "marks": 20, "page": 1, "year": 2008},
+{"question": "Describe the approach to a patient with haemoptysis", "marks": 20, "page": 1, "year": 2008},
+{"question": "Write short notes on: Holter monitoring", "marks": 10, "page": 2, "year": 2008},
+{"question": "Write short notes on: Pulmonary function tests", "marks": 10, "page": 2, "year": 2008},
+{"question": "Write short notes on: Digoxin toxicity", "marks": 10, "page": 2, "year": 2008},
+{"question": "Write short notes on: Sleep apnoea syndrome", "marks": 10, "page": 2, "year": 2008},
+{"question": "Write short notes on: Brugada syndrome", "marks": 10, "page": 2, "year": 2008},
+{"question": "Write short notes on: Bronchial thermoplasty", "marks": 10, "page": 2, "year": 2008}]}
+
+### SAMPLE INPUT 3 ###
+--- Page 1 ---
+Q.P. Code: 4412                                   Reg. No.: ..........
+B.D.S. DEGREE EXAMINATION, FEB. '97
+Third Year – Oral Pathology and Microbiology
+1. Classify odontogenic cysts. Describe the pathogenesis and histo-
+pathology of the odontogenic keratocyst. (15)
+OR
+Describe the aetiology and histopathology of oral submucous fibrosis. (15)
+2. Short answers: (4 x 5 = 20)
+a) Rushton bodies   b) Tzanck cells   c) Ghost cells   d) Dens in dente
+
+--- Page 2 ---
+3. Multiple choice: (10 x 1 = 10)
+i) The most common site of oral squamous cell carcinoma is: (a) lip (b) lateral border of tongue (c) palate (d) gingiva
+ii) Pindborg tumour is also known as: (a) ameloblastoma (b) CEOT (c) AOT (d) odontoma
+iii) Koplik's spots are seen in: (a) measles (b) mumps (c) rubella (d) chickenpox
+- 2 -                                                              P.T.O.
+
+### SAMPLE OUTPUT 3 ###
+{"paper_title": "B.D.S. DEGREE EXAMINATION, FEB. '97 – Third Year – Oral Pathology and Microbiology", "questions": [
+{"question": "Classify odontogenic cysts. Describe the pathogenesis and histopathology of the odontogenic keratocyst", "marks": 15, "page": 1, "year": 1997},
+{"question": "Describe the aetiology and histopathology of oral submucous fibrosis", "marks": 15, "page": 1, "year": 1997},
+{"question": "Short answers: Rushton bodies", "marks": 5, "page": 1, "year": 1997},
+{"question": "Short answers: Tzanck cells", "marks": 5, "page": 1, "year": 1997},
+{"question": "Short answers: Ghost cells", "marks": 5, "page": 1, "year": 1997},
+{"question": "Short answers: Dens in dente", "marks": 5, "page": 1, "year": 1997},
+{"question": "The most common site of oral squamous cell carcinoma is: (a) lip (b) lateral border of tongue (c) palate (d) gingiva", "marks": 1, "page": 2, "year": 1997},
+{"question": "Pindborg tumour is also known as: (a) ameloblastoma (b) CEOT (c) AOT (d) odontoma", "marks": 1, "page": 2, "year": 1997},
+{"question": "Koplik's spots are seen in: (a) measles (b) mumps (c) rubella (d) chickenpox", "marks": 1, "page": 2, "year": 1997}]}
+"""
 
-### CSV OUTPUT ###
+# OpenAI only caches prompt prefixes of 1024+ tokens; below that every request pays full price
+prompt_cache_min_tokens = 1024
+system_prompt_tokens = count_tokens(system_prompt)
+if system_prompt_tokens < prompt_cache_min_tokens:
+    print(
+        f"Warning: system_prompt is {system_prompt_tokens} tokens, under the "
+        f"{prompt_cache_min_tokens} needed for prompt caching; requests will cost more"
+    )
+
+
+def build_prompt(combined_text):
+    """Variable tail of the request: only the pages of one chunk."""
+    return f"""### TEXT TO CONVERT ###
+{combined_text}
 """
 
+
+def chunk_prompt(page_blocks):
+    return build_prompt("".join(page_blocks))
+
+
+def build_request_body(prompt):
+    """Chat completion parameters shared by the sync and batch paths."""
+    return {
+        "model": model_name,
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.1,
+        "max_tokens": max_completion_tokens,
+        "response_format": {"type": "json_schema", "json_schema": exam_schema},
+    }
+
+
+def parse_exam_json(content):
+    """Parse one structured-output reply. Returns None if it isn't usable."""
+    try:
+        return json.loads(content or "")
+    except json.JSONDecodeError:
+        return None
+
+
+def merge_exam_jsons(parts):
+    """Merge (exam_json, complete) replies for consecutive page runs into one."""
+    exam_jsons = [exam_json for exam_json, _ in parts if exam_json is not None]
+    complete = all(part_complete for _, part_complete in parts)
+    if not exam_jsons:
+        return None, False
+    merged = {
+        "paper_title": exam_jsons[0]["paper_title"],
+        "questions": [q for exam_json in exam_jsons for q in exam_json["questions"]],
+    }
+    return merged, complete
+
+
+def build_csv_rows(exam_prefix, chunks):
+    """Flatten {chunk_idx: exam_json} into CSV rows in chunk order."""
+    rows = []
+    if not chunks:
+        return rows
+    # Only the first chunk contains the exam heading; later chunks' titles are guesses
+    paper_title = chunks[min(chunks)]["paper_title"]
+    for chunk_idx in sorted(chunks):
+        for q in chunks[chunk_idx]["questions"]:
+            rows.append([q["question"], q["marks"], paper_title, f"{exam_prefix}.pdf", q["page"], q["year"]])
+    return rows
+
+
+def estimate_tokens(request_body):
+    """Token cost of a request: prompt tokens plus the completion budget."""
+    prompt_tokens = sum(count_tokens(message["content"]) for message in request_body["messages"])
+    return prompt_tokens + request_body["max_tokens"]
+
+
+class RateLimiter:
+    """Leaky bucket enforcing requests-per-minute and tokens-per-minute."""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = requests_per_minute
+        self.available_tokens = tokens_per_minute
+        self.last_update = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_requests = min(
+            self.requests_per_minute, self.available_requests + self.requests_per_minute * elapsed / 60
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute, self.available_tokens + self.tokens_per_minute * elapsed / 60
+        )
+
+    async def acquire(self, tokens):
+        """Wait until both buckets have capacity, then consume it."""
+        # A single request larger than the bucket would otherwise wait forever
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                missing_requests = max(0, 1 - self.available_requests) / self.requests_per_minute
+                missing_tokens = max(0, tokens - self.available_tokens) / self.tokens_per_minute
+                await asyncio.sleep(max(missing_requests, missing_tokens) * 60)
+
+
+async def probe_rate_limiter():
+    """Read the account's RPM/TPM limits from a 1-token request."""
+    requests_per_minute, tokens_per_minute = max_requests_per_minute, max_tokens_per_minute
+    try:
+        probe = build_request_body("ping")
+        probe["max_tokens"] = 1
+        raw = await client.chat.completions.with_raw_response.create(**probe)
+        requests_per_minute = int(raw.headers.get("x-ratelimit-limit-requests", requests_per_minute))
+        tokens_per_minute = int(raw.headers.get("x-ratelimit-limit-tokens", tokens_per_minute))
+        print(f"Rate limits: {requests_per_minute} RPM, {tokens_per_minute} TPM")
+    except Exception as e:
+        print(f" Could not probe rate limits, using defaults: {e}")
+    return RateLimiter(requests_per_minute, tokens_per_minute)
+
+
+@retry(
+    wait=wait_random_exponential(min=1, max=60),
+    stop=stop_after_attempt(6),
+    retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+)
+async def create_completion(rate_limiter, request_body):
+    """Throttled chat completion, retried with exponential backoff on 429s, 5xx, timeouts and connection errors."""
+    await rate_limiter.acquire(estimate_tokens(request_body))
+    return await client.chat.completions.create(**request_body)
+
+
+async def request_pages(rate_limiter, exam_prefix, chunk_idx, page_blocks):
+    """Request one run of pages. Returns (exam_json, complete); exam_json is None if nothing
+    could be extracted."""
+    try:
+        response = await create_completion(rate_limiter, build_request_body(chunk_prompt(page_blocks)))
+    except Exception as e:
+        print(f" API Error for {exam_prefix}, chunk {chunk_idx}: {e}")
+        return None, False
+
+    choice = response.choices[0]
+    if choice.finish_reason == "length":
+        return await split_and_request(rate_limiter, exam_prefix, chunk_idx, page_blocks)
+
+    exam_json = parse_exam_json(choice.message.content)
+    if exam_json is None:
+        print(f" Unparseable reply for {exam_prefix}, chunk {chunk_idx}")
+        return None, False
+    return exam_json, True
+
+
+async def split_and_request(rate_limiter, exam_prefix, chunk_idx, page_blocks):
+    """A reply cut off at max_tokens is invalid JSON, so re-request each half of the pages."""
+    if len(page_blocks) == 1:
+        print(f" Reply truncated for {exam_prefix}, chunk {chunk_idx} on a single page, skipping it")
+        return None, False
+
+    print(f" Reply truncated for {exam_prefix}, chunk {chunk_idx}, splitting {len(page_blocks)} pages in half")
+    middle = len(page_blocks) // 2
+    halves = await asyncio.gather(
+        request_pages(rate_limiter, exam_prefix, chunk_idx, page_blocks[:middle]),
+        request_pages(rate_limiter, exam_prefix, chunk_idx, page_blocks[middle:]),
+    )
+    return merge_exam_jsons(halves)
+
+
+async def process_chunk(rate_limiter, exam_prefix, chunk_idx, page_blocks, total_chunks):
+    """Send one chunk through the synchronous API. Returns (exam_json, complete)."""
+    exam_json, complete = await request_pages(rate_limiter, exam_prefix, chunk_idx, page_blocks)
+    if exam_json is not None:
+        print(f"Processed chunk {chunk_idx}/{total_chunks} for {exam_prefix}")
+    return exam_json, complete
+
+
+async def process_exam(rate_limiter, exam_prefix, chunks):
+    """Send every chunk of one exam concurrently. Returns {chunk_idx: (exam_json, complete)}."""
+    replies = await asyncio.gather(*(
+        process_chunk(rate_limiter, exam_prefix, chunk_idx, page_blocks, len(chunks))
+        for chunk_idx, page_blocks in chunks
+    ))
+    return {
+        chunk_idx: reply
+        for (chunk_idx, _), reply in zip(chunks, replies)
+        if reply[0] is not None
+    }
+
+
+def build_batch_jsonl(all_exams):
+    """Build Batch API input with one line per chunk across all exams."""
+    lines = []
+    for exam_prefix, chunks in all_exams.items():
+        for chunk_idx, page_blocks in chunks:
+            lines.append(json.dumps({
+                "custom_id": f"{exam_prefix}::{chunk_idx}",
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": build_request_body(chunk_prompt(page_blocks)),
+            }))
+    return "\n".join(lines) + "\n"
+
+
+async def read_batch_file(file_id):
+    """Parsed JSONL lines of a batch output or error file."""
+    content = await client.files.content(file_id)
+    return [json.loads(line) for line in content.text.splitlines() if line.strip()]
+
+
+async def submit_batch(all_exams, cache):
+    """Submit the batch, or resume the one already submitted for the same input on an
+    earlier (interrupted) run. Its id is kept in the cache until it finishes."""
+    batch_input = build_batch_jsonl(all_exams)
+    batch_key = "batch::" + hashlib.sha256(batch_input.encode("utf-8")).hexdigest()
+
+    if batch_key in cache:
+        try:
+            batch = await client.batches.retrieve(cache[batch_key])
+            if batch.status not in ("failed", "cancelled"):
+                print(f"Resuming batch {batch.id} ({batch.status})")
+                return batch_key, batch
+        except Exception as e:
+            print(f" Could not resume batch {cache[batch_key]}: {e}")
+
+    batch_file = await client.files.create(
+        file=("batch_input.jsonl", io.BytesIO(batch_input.encode("utf-8"))),
+        purpose="batch",
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    cache[batch_key] = batch.id
+    cache.sync()
+    print(f"Submitted batch {batch.id}, waiting for results...")
+    return batch_key, batch
+
+
+async def process_batch(all_exams, cache):
+    """Run all chunks through the Batch API. Returns ({exam_prefix: {chunk_idx: exam_json}},
+    {exam_prefix: [(chunk_idx, page_blocks)]} to retry through the sync API),
+    or None if the batch can't be used."""
+    if not any(all_exams.values()):
+        return {}, {}
+
+    try:
+        batch_key, batch = await submit_batch(all_exams, cache)
+    except Exception as e:
+        print(f" Batch API unavailable, falling back to sync: {e}")
+        return None
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        await asyncio.sleep(batch_poll_interval)
         try:
-            response = client.chat.completions.create(
-                model="gpt-3.5-turbo",  # or gpt-4o-mini if available
-                messages=[
-                    {"role": "system", "content": "You are a precise CSV data extractor. Output only valid CSV rows."},
-                    {"role": "user", "content": prompt},
-                ],
-                temperature=0.1,
-                max_tokens=3000,
-            )
-            chunk_csv = response.choices[0].message.content.strip()  # type: ignore
-            if chunk_csv:
-                all_csv_rows.append(chunk_csv)
-                print(f"Processed chunk {chunk_idx}/{len(file_chunks)} for {exam_prefix}")
+            batch = await client.batches.retrieve(batch.id)
         except Exception as e:
-            print(f" API Error for {exam_prefix}, chunk {chunk_idx}: {e}")
+            print(f" Error polling batch {batch.id}: {e}")
+
+    if batch.status not in ("completed", "expired"):
+        del cache[batch_key]
+        print(f" Batch {batch.id} ended with status {batch.status}, falling back to sync")
+        return None
+
+    # 🔹 Route each result back to (exam_prefix, chunk_idx); an expired batch still
+    # has output for the requests it finished, the rest are retried below
+    chunk_results = defaultdict(dict)
+    try:
+        results = await read_batch_file(batch.output_file_id) if batch.output_file_id else []
+        errors = await read_batch_file(batch.error_file_id) if batch.error_file_id else []
+    except Exception as e:
+        # Keep the batch id so the next run can download these results again
+        print(f" Error downloading batch {batch.id} results, falling back to sync: {e}")
+        return None
+
+    for result in results + errors:
+        exam_prefix, chunk_idx = result["custom_id"].rsplit("::", 1)
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            print(f" API Error for {exam_prefix}, chunk {chunk_idx}: {result.get('error') or response}")
+            continue
+        choice = response["body"]["choices"][0]
+        if choice.get("finish_reason") == "length":
+            # Truncated JSON: the sync path splits the chunk and re-requests it
             continue
+        exam_json = parse_exam_json(choice["message"]["content"])
+        if exam_json is None:
+            print(f" Unparseable reply for {exam_prefix}, chunk {chunk_idx}")
+            continue
+        chunk_results[exam_prefix][int(chunk_idx)] = exam_json
+
+    # 🔹 Failed, truncated or missing chunks go through the sync API
+    retry_exams = defaultdict(list)
+    for exam_prefix, chunks in all_exams.items():
+        for chunk_idx, page_blocks in chunks:
+            if chunk_idx not in chunk_results[exam_prefix]:
+                retry_exams[exam_prefix].append((chunk_idx, page_blocks))
+    del cache[batch_key]
 
-    return "\n".join(all_csv_rows)
+    retry_count = sum(len(chunks) for chunks in retry_exams.values())
+    if retry_count:
+        print(f"Retrying {retry_count} chunks from batch {batch.id} through the sync API")
 
+    return chunk_results, retry_exams
 
-def save_individual_csv(exam_prefix, csv_output):
+
+def save_individual_csv(exam_prefix, csv_rows):
     """Save extracted CSV for one exam."""
-    if not csv_output.strip():
+    if not csv_rows:
         print(f" No data for {exam_prefix}")
         return False
 
     output_csv = os.path.join(output_folder, f"{exam_prefix}.csv")
     try:
-        with open(output_csv, "w", encoding="utf-8", newline="") as f:
-            f.write("question,marks,paper_title,filename,page,year\n")
-            f.write(csv_output + "\n")
+        with open(output_csv, "w", encoding="utf-8", newline="", buffering=write_buffer_size) as f:
+            writer = csv.writer(f)
+            writer.writerow(csv_header)
+            writer.writerows(csv_rows)
 
-        count = csv_output.count("\n") + 1
+        count = len(csv_rows)
         print(f" Saved {output_csv} ({count} questions)")
         return True
     except Exception as e:
@@ -173,14 +646,13 @@ def save_combined_csv(all_exam_data):
     """Save one combined CSV with all exams merged."""
     combined_csv = os.path.join(output_folder, "all_exams_combined.csv")
     try:
-        with open(combined_csv, "w", encoding="utf-8", newline="") as f:
-            f.write("question,marks,paper_title,filename,page,year\n")
+        with open(combined_csv, "w", encoding="utf-8", newline="", buffering=write_buffer_size) as f:
+            writer = csv.writer(f)
+            writer.writerow(csv_header)
             total_questions = 0
-            for exam_prefix, csv_output in all_exam_data.items():
-                for row in csv_output.splitlines():
-                    if row.strip():
-                        f.write(row + "\n")
-                        total_questions += 1
+            for exam_prefix, csv_rows in all_exam_data.items():
+                writer.writerows(csv_rows)
+                total_questions += len(csv_rows)
         print(f" Combined CSV saved: {combined_csv} ({total_questions} total questions)")
         return True
     except Exception as e:
@@ -188,24 +660,108 @@ def save_combined_csv(all_exam_data):
         return False
 
 
-def main():
+def cache_key(page_blocks):
+    """Exact-match cache key for one chunk: model, prompt version, the static system prompt
+    and response schema (so editing either can't serve stale replies), and the chunk's pages."""
+    key_material = "\0".join([
+        model_name, str(prompt_version), system_prompt, json.dumps(exam_schema, sort_keys=True), chunk_prompt(page_blocks),
+    ])
+    return hashlib.sha256(key_material.encode("utf-8")).hexdigest()
+
+
+async def fetch_chunks(pending_exams, cache):
+    """Run chunks through the Batch API, then anything it couldn't answer concurrently
+    through the sync API. Returns {exam_prefix: {chunk_idx: (exam_json, complete)}}."""
+    chunk_results = defaultdict(dict)
+    sync_exams = pending_exams
+
+    batch_results = await process_batch(pending_exams, cache) if use_batch_api else None
+    if batch_results is not None:
+        batch_chunks, sync_exams = batch_results
+        for exam_prefix, chunks in batch_chunks.items():
+            for chunk_idx, exam_json in chunks.items():
+                chunk_results[exam_prefix][chunk_idx] = (exam_json, True)
+
+    if sync_exams:
+        rate_limiter = await probe_rate_limiter()
+        exam_chunks = await asyncio.gather(*(
+            process_exam(rate_limiter, exam_prefix, chunks)
+            for exam_prefix, chunks in sync_exams.items()
+        ))
+        for exam_prefix, chunks in zip(sync_exams, exam_chunks):
+            chunk_results[exam_prefix].update(chunks)
+
+    return chunk_results
+
+
+async def run_exams(all_exams):
+    """Answer chunks from the cache where possible, fetch the rest, and join per exam."""
+    chunk_results = defaultdict(dict)
+
+    with shelve.open(cache_path) as cache:
+        pending_exams = defaultdict(list)
+        for exam_prefix, chunks in all_exams.items():
+            for chunk_idx, page_blocks in chunks:
+                key = cache_key(page_blocks)
+                if key in cache:
+                    chunk_results[exam_prefix][chunk_idx] = cache[key]
+                else:
+                    pending_exams[exam_prefix].append((chunk_idx, page_blocks))
+
+        cached_count = sum(len(chunks) for chunks in chunk_results.values())
+        if cached_count:
+            print(f"Reused {cached_count} cached chunks")
+
+        if pending_exams:
+            fetched = await fetch_chunks(pending_exams, cache)
+            blocks_by_chunk = {
+                (exam_prefix, chunk_idx): page_blocks
+                for exam_prefix, chunks in pending_exams.items()
+                for chunk_idx, page_blocks in chunks
+            }
+            for exam_prefix, chunks in fetched.items():
+                for chunk_idx, (exam_json, complete) in chunks.items():
+                    # Partial results (a truncated page was skipped) are used but not cached
+                    if complete:
+                        cache[cache_key(blocks_by_chunk[(exam_prefix, chunk_idx)])] = exam_json
+                    chunk_results[exam_prefix][chunk_idx] = exam_json
+
+    return {
+        exam_prefix: build_csv_rows(exam_prefix, chunks)
+        for exam_prefix, chunks in chunk_results.items()
+    }
+
+
+def main(exam_pages=None):
+    """Convert exams to CSV. exam_pages ({exam_prefix: [(page_number, text), ...]}) comes
+    straight from pdf_reader when run in-process; otherwise pages are read from txt_outputs."""
     print("Starting multi-page exam processing...")
 
-    groups = group_files()
-    if not groups:
-        print("No text files found!")
+    if exam_pages is None:
+        groups = group_files()
+        if not groups:
+            print("No text files found!")
+            return
+        exam_pages = {exam_prefix: read_exam_pages(files) for exam_prefix, files in groups.items()}
+
+    if not exam_pages:
+        print("No exam pages found!")
         return
 
-    print(f"Found {len(groups)} exam groups")
+    print(f"Found {len(exam_pages)} exam groups")
 
-    all_exam_data = {}
+    all_exams = {}
+    for exam_prefix, pages in exam_pages.items():
+        print(f"\nPreparing exam {exam_prefix} ({len(pages)} pages)")
+        all_exams[exam_prefix] = build_exam_chunks(pages)
+
+    exam_outputs = asyncio.run(run_exams(all_exams))
 
-    for exam_prefix, files in groups.items():
-        sorted_files = sorted(files, key=extract_page_number)
-        print(f"\nProcessing exam {exam_prefix} ({len(sorted_files)} pages)")
-        csv_output = process_exam(exam_prefix, sorted_files)
-        if save_individual_csv(exam_prefix, csv_output):
-            all_exam_data[exam_prefix] = csv_output
+    all_exam_data = {}
+    for exam_prefix in tqdm(all_exams, desc="Saving exams", unit="exam"):
+        csv_rows = exam_outputs.get(exam_prefix, [])
+        if save_individual_csv(exam_prefix, csv_rows):
+            all_exam_data[exam_prefix] = csv_rows
 
     if all_exam_data:
         save_combined_csv(all_exam_data)
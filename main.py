@@ -1,24 +1,19 @@
-import subprocess
-import sys
-import os
+from pdf_reader import OUTPUT_FOLDER, PDF_FOLDER, SAVE_MODE, process_all_pdfs
 
-def run_script(script_name):
-    """Run another Python script and stream output live"""
-    try:
-        result = subprocess.run([sys.executable, script_name], check=True)
-        return result.returncode
-    except subprocess.CalledProcessError as e:
-        print(f"Error while running {script_name}: {e}")
-        sys.exit(1)
+SAVE_TXT_OUTPUTS = False  # also write txt_outputs/ (useful for debugging extraction)
 
 def main():
+    # Imported here, not at module level: pdf_reader's worker processes re-import this
+    # module under spawn and must not repeat ai's setup (client, tokenizer download)
+    import ai
+
     print("Step 1: Extracting text from PDFs...")
-    run_script("pdf_reader.py")
+    exam_pages = process_all_pdfs(PDF_FOLDER, OUTPUT_FOLDER, SAVE_MODE, save_files=SAVE_TXT_OUTPUTS)
 
     print("\nStep 2: Converting text to CSV with AI...")
-    run_script("ai.py")
+    ai.main(exam_pages)
 
-    print("\nWorkflow complete! Check txt_outputs/ and csv_outputs/")
+    print("\nWorkflow complete! Check csv_outputs/")
 
 if __name__ == "__main__":
     main()
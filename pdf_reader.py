@@ -1,8 +1,16 @@
 import os
 import io
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import repeat
 import fitz
-import pytesseract
 from PIL import Image
+
+# Parallelism comes from processes x OCR threads; keep Tesseract itself single-threaded
+# (must be set before libtesseract loads)
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+from tesserocr import PSM, PyTessBaseAPI
 from tqdm import tqdm
 
 PDF_FOLDER = "./pdfs"
@@ -10,65 +18,157 @@ OUTPUT_FOLDER = "./txt_outputs"
 os.makedirs(OUTPUT_FOLDER, exist_ok=True)
 
 SAVE_MODE = "separate"  # or "combined"
+TEXT_DENSITY_THRESHOLD = 0.001  # chars per pt² (~500 chars on an A4 page) = text layer is complete
+MIN_OCR_PIXELS = 200 * 200  # smaller images are logos/icons, not scanned text
+WRITE_THREADS = 4
+WRITE_BUFFER_SIZE = 1 << 20
+SCAN_RENDER_DPI = 200  # grayscale render used for pages without a text layer
+OCR_THREADS = 4  # tesserocr releases the GIL while recognizing, so threads overlap fine
+
+# One OCR pool per worker process, and one Tesseract engine per OCR thread, created
+# on first use and reused for every page and image of every PDF the worker handles
+_ocr_pool = None
+_tesseract = threading.local()
+
+
+def get_ocr_pool() -> ThreadPoolExecutor:
+    global _ocr_pool
+    if _ocr_pool is None:
+        _ocr_pool = ThreadPoolExecutor(max_workers=OCR_THREADS)
+    return _ocr_pool
+
+
+def get_tesseract_api() -> PyTessBaseAPI:
+    if not hasattr(_tesseract, "api"):
+        _tesseract.api = PyTessBaseAPI(lang="eng", psm=PSM.AUTO)
+    return _tesseract.api
+
+
+def ocr_pil_image(image: Image.Image) -> str:
+    # tesserocr hands images to Tesseract as BMP, which can't hold CMYK, LA, I;16, ...
+    if image.mode not in ("1", "L", "P", "RGB", "RGBA"):
+        image = image.convert("RGB")
+    api = get_tesseract_api()
+    api.SetImage(image)
+    return api.GetUTF8Text().strip()
+
+
+def ocr_image(image_bytes: bytes) -> str:
+    with Image.open(io.BytesIO(image_bytes)) as image:
+        return ocr_pil_image(image)
+
+
+def render_page(page: fitz.Page) -> Image.Image:
+    pix = page.get_pixmap(dpi=SCAN_RENDER_DPI, colorspace=fitz.csGRAY)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
 
 
-def extract_text_from_pdf(pdf_path: str, output_folder: str, save_mode: str = "combined") -> str:
+def write_text_file(path_and_text: tuple[str, str]) -> None:
+    path, text = path_and_text
+    with open(path, "w", encoding="utf-8", buffering=WRITE_BUFFER_SIZE) as f:
+        f.write(text)
+
+
+def extract_text_from_pdf(
+    pdf_path: str, output_folder: str, save_mode: str = "combined", save_files: bool = True
+) -> tuple[str, list[tuple[int, str]]]:
+    """Returns a status message and the (page_number, text) pairs; files are only written if save_files."""
     filename = os.path.splitext(os.path.basename(pdf_path))[0]
 
     try:
         document = fitz.open(pdf_path)
     except Exception as e:
-        return f" Failed to open {pdf_path}: {e}"
+        return f" Failed to open {pdf_path}: {e}", []
 
+    pages = []
     extracted_text = []
+    page_outputs = []
+    ocr_pool = get_ocr_pool()
+    pending = deque()  # (page_number, page_text, OCR futures) in page order
+    max_pending_pages = OCR_THREADS * 2  # bounds rendered pages waiting in memory
+
+    def finish_page(page_number, page_text, ocr_futures):
+        ocr_texts = [text for text in (future.result() for future in ocr_futures) if text]
+        combined_text = "\n\n".join([page_text, *ocr_texts])
+        pages.append((page_number, combined_text))
+
+        # Save per mode (separate pages are flushed together after the loop)
+        if save_mode == "separate":
+            page_file = os.path.join(output_folder, f"{filename}_page_{page_number}.txt")
+            page_outputs.append((page_file, combined_text))
+        else:
+            extracted_text.append(f"\n\n--- Page {page_number} ---\n{combined_text}")
 
     # Per-page progress bar
-    for page_num in tqdm(range(document.page_count), desc=f"Processing {filename}", unit="page"):
+    for page_num in tqdm(range(document.page_count), desc=f"Processing {filename}", unit="page", leave=False):
         page = document[page_num]
         page_text = page.get_text().strip() # type: ignore
 
-        # OCR images
-        ocr_texts = []
-        for img in page.get_images(full=True):
+        # fitz isn't thread-safe: render/extract here, OCR on the pool
+        ocr_futures = []
+        images = []
+        if not page_text:
+            # Scanned page: OCR one full-page render instead of each image fragment
+            ocr_futures.append(ocr_pool.submit(ocr_pil_image, render_page(page)))
+        else:
+            # Skip OCR when the native text layer already covers the page
+            text_density = len(page_text) / max(page.rect.width * page.rect.height, 1)
+            if text_density < TEXT_DENSITY_THRESHOLD:
+                images = page.get_images(full=True)
+
+        for img in images:
             xref = img[0]
             base_image = document.extract_image(xref)
             image_bytes = base_image.get("image")
-            if image_bytes:
-                with Image.open(io.BytesIO(image_bytes)) as image:
-                    text_from_image = pytesseract.image_to_string(image).strip()
-                    if text_from_image:
-                        ocr_texts.append(text_from_image)
+            if image_bytes and base_image.get("width", 0) * base_image.get("height", 0) >= MIN_OCR_PIXELS:
+                ocr_futures.append(ocr_pool.submit(ocr_image, image_bytes))
 
-        combined_text = page_text
-        if ocr_texts:
-            combined_text += "\n\n" + "\n\n".join(ocr_texts)
+        # Drop MuPDF's cached decoded images, but only after pages that actually decoded
+        # or rendered some; emptying the store also evicts shared fonts/resources
+        if not page_text or images:
+            fitz.TOOLS.store_shrink(100)
 
-        # Save per mode
-        if save_mode == "separate":
-            page_file = os.path.join(output_folder, f"{filename}_page_{page_num + 1}.txt")
-            with open(page_file, "w", encoding="utf-8") as f:
-                f.write(combined_text)
-        else:
-            extracted_text.append(f"\n\n--- Page {page_num + 1} ---\n{combined_text}")
+        # Later pages keep rendering while earlier ones are OCR'd; results stay in page order
+        pending.append((page_num + 1, page_text, ocr_futures))
+        while len(pending) > max_pending_pages:
+            finish_page(*pending.popleft())
+
+    while pending:
+        finish_page(*pending.popleft())
 
     document.close()
 
     if save_mode == "combined" and extracted_text:
         output_file = os.path.join(output_folder, f"{filename}.txt")
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write("\n".join(extracted_text))
+        page_outputs.append((output_file, "\n".join(extracted_text)))
+
+    if save_files:
+        with ThreadPoolExecutor(max_workers=WRITE_THREADS) as write_pool:
+            list(write_pool.map(write_text_file, page_outputs))
 
-    return f"Processed: {filename} ({save_mode})"
+    return f"Processed: {filename} ({save_mode if save_files else 'in memory'})", pages
 
 
-def process_all_pdfs(pdf_folder: str, output_folder: str, save_mode: str = "combined"):
+def process_all_pdfs(
+    pdf_folder: str, output_folder: str, save_mode: str = "combined", save_files: bool = True
+) -> dict[str, list[tuple[int, str]]]:
+    """Extract every PDF; returns {pdf stem: [(page_number, text), ...]}."""
     pdf_files = [f for f in os.listdir(pdf_folder) if f.lower().endswith(".pdf")]
-    for pdf in tqdm(pdf_files, desc="Overall PDFs", unit="pdf"):
-        pdf_path = os.path.join(pdf_folder, pdf)
-        result = extract_text_from_pdf(pdf_path, output_folder, save_mode)
-        print(result)
+    pdf_paths = [os.path.join(pdf_folder, pdf) for pdf in pdf_files]
+    exam_pages = {}
+
+    # One PDF per CPU core
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+        results = executor.map(
+            extract_text_from_pdf, pdf_paths, repeat(output_folder), repeat(save_mode), repeat(save_files)
+        )
+        for pdf_path, (message, pages) in tqdm(zip(pdf_paths, results), total=len(pdf_paths), desc="Overall PDFs", unit="pdf"):
+            print(message)
+            if pages:
+                exam_pages[os.path.splitext(os.path.basename(pdf_path))[0]] = pages
 
     print(" All PDFs processed successfully!")
+    return exam_pages
 
 
 if __name__ == "__main__":